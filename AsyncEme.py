@@ -0,0 +1,125 @@
+#Asyncio facade over ExEme.EmeArchive for serving entries from an event loop.
+#
+#   archive = AsyncEmeArchive("data.eme")
+#   data = await archive.read("script/start.txt")
+#   async for chunk in archive.stream("bgm/title.ogg"):
+#       ...
+#
+#Decryption and LZSS decoding run in a bounded thread pool. lzss/lzss_python.c releases
+#the GIL while decoding, but only once the extension is rebuilt from source: the checked-in
+#lzss.cp313-win_amd64.pyd predates that change and still decodes one thread at a time.
+#Concurrent reads of the same entry share one decode. Uncompressed entries are streamed
+#from the file chunk by chunk, compressed ones have to be decoded whole first.
+#
+#An archive can be used from several event loops in turn (e.g. repeated asyncio.run),
+#each loop gets its own backpressure and coalescing.
+
+import asyncio
+import weakref
+from concurrent.futures import ThreadPoolExecutor
+from typing import AsyncIterator, Dict, Tuple
+
+from ExEme import EmeArchive
+
+
+class AsyncEmeArchive:
+    def __init__(self, path: str, max_workers: int = 4, max_pending: int = 64):
+        """Parse the archive index (blocking) and set up the decode pool.
+
+        max_workers bounds the decode threads, max_pending bounds the decodes that may be
+        queued on them at once; further reads wait until a slot frees up.
+        """
+        self._archive = EmeArchive(path)
+        self._entries: Dict[str, dict] = {e['name']: e for e in self._archive.entries}
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="eme")
+        self._max_pending = max_pending
+        # Event loop -> (decode slots, in-flight decodes by name)
+        self._loops = weakref.WeakKeyDictionary()
+
+    @property
+    def path(self) -> str:
+        return self._archive.path
+
+    @property
+    def entries(self):
+        return self._archive.entries
+
+    def __contains__(self, name: str) -> bool:
+        return name in self._entries
+
+    async def read(self, name: str) -> bytes:
+        """Return the extracted data of an entry"""
+        entry = self._entries.get(name)
+        if entry is None:
+            raise KeyError(name)
+
+        _, inflight = self._loop_state()
+        task = inflight.get(name)
+        if task is None:
+            task = asyncio.ensure_future(self._run(self._extract, entry))
+            inflight[name] = task
+            task.add_done_callback(lambda _: inflight.pop(name, None))
+
+        # Shielded so one cancelled caller does not cancel the decode shared with the others
+        return await asyncio.shield(task)
+
+    async def stream(self, name: str, chunk_size: int = 0x10000) -> AsyncIterator[bytes]:
+        """Yield the extracted data of an entry in chunks"""
+        entry = self._entries.get(name)
+        if entry is None:
+            raise KeyError(name)
+
+        if entry['lzss_frame_size'] != 0:
+            data = memoryview(await self.read(name))
+            for i in range(0, len(data), chunk_size):
+                yield bytes(data[i:i + chunk_size])
+                await asyncio.sleep(0)
+            return
+
+        # Same bytes as ExEme.EmeArchive.extract: the decrypted 12-byte header, then packed_size raw bytes
+        f = await self._run(open, self.path, "rb")
+        try:
+            start, end = 0, 12 + entry['packed_size']
+            while start < end:
+                size = min(max(chunk_size, 12) if start == 0 else chunk_size, end - start)
+                chunk = await self._run(self._read_chunk, f, entry, start, size)
+                if not chunk:
+                    break
+                yield chunk
+                start += len(chunk)
+        finally:
+            f.close()
+
+    def _loop_state(self) -> Tuple[asyncio.Semaphore, Dict[str, asyncio.Task]]:
+        loop = asyncio.get_running_loop()
+        state = self._loops.get(loop)
+        if state is None:
+            state = self._loops[loop] = (asyncio.Semaphore(self._max_pending), {})
+        return state
+
+    async def _run(self, func, *args):
+        """Run func in the pool once one of the max_pending slots is free"""
+        slots, _ = self._loop_state()
+        async with slots:
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(self._executor, func, *args)
+
+    def _extract(self, entry: dict) -> bytes:
+        return self._archive.extract(entry).getvalue()
+
+    def _read_chunk(self, f, entry: dict, start: int, size: int) -> bytes:
+        """Bytes start to start + size of an uncompressed entry, the chunk at 0 holds the whole header"""
+        f.seek(entry['offset'] + start)
+        data = bytearray(f.read(size))
+        if start == 0:
+            self._archive._decrypt(data, 0, 12)
+        return bytes(data)
+
+    def close(self) -> None:
+        self._executor.shutdown(wait=False)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        self.close()
@@ -0,0 +1,134 @@
+#Manifest (metadata) readers and writers shared by ExEme and PkEme.
+#
+#  metadata.json  - one indented JSON document: {"key": ..., "entries": [...]}
+#  metadata.jsonl - JSON Lines: first line is {"key": ...}, then one entry per line and a
+#                   final {"count": N} trailer. Written while extracting and read back entry
+#                   by entry when packing. The file is written as metadata.jsonl.tmp and
+#                   renamed once complete, so an interrupted dump keeps the previous manifest.
+#                   A file without the trailer is incomplete and rejected.
+
+import os
+import sys
+import json
+from typing import Dict, Iterator
+
+JSON_NAME = "metadata.json"
+JSONL_NAME = "metadata.jsonl"
+
+
+def is_jsonl(path: str) -> bool:
+    return path.lower().endswith(".jsonl")
+
+
+class ManifestWriter:
+    """Incremental JSON Lines manifest writer, path only appears once finish() is called."""
+
+    def __init__(self, path: str, key: str, **fields):
+        self.path = path
+        self.count = 0
+        self._tmp_path = path + ".tmp"
+        self._file = open(self._tmp_path, "w")
+        self._file.write(json.dumps(dict(key=key, **fields)) + "\n")
+
+    def write(self, entry: Dict) -> None:
+        self._file.write(json.dumps(entry, separators=(",", ":")) + "\n")
+        self.count += 1
+
+    def finish(self) -> None:
+        """Write the trailer that marks the manifest complete and move it to path."""
+        if not self._file.closed:
+            self._file.write(json.dumps({"count": self.count}) + "\n")
+            self._file.close()
+            os.replace(self._tmp_path, self.path)
+
+    def close(self) -> None:
+        """Discard an unfinished manifest, whatever was at path is left untouched."""
+        if not self._file.closed:
+            self._file.close()
+            os.remove(self._tmp_path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, *exc):
+        if exc_type is None:
+            self.finish()
+        else:
+            self.close()
+
+
+def read_header(path: str) -> Dict:
+    """Return the top-level fields of a manifest (key and archive info), without the entries."""
+    with open(path, "r") as f:
+        if is_jsonl(path):
+            return json.loads(f.readline())
+        header = json.load(f)
+        header.pop("entries", None)
+        return header
+
+
+def read_key(path: str) -> str:
+    """Return the hex key stored in a manifest."""
+    return read_header(path)["key"]
+
+
+def iter_entries(path: str) -> Iterator[Dict]:
+    """Yield manifest entries one at a time.
+
+    JSON Lines manifests are streamed; legacy metadata.json has to be loaded whole.
+    Raises ValueError when a JSON Lines manifest has no trailer or its count is wrong.
+    """
+    with open(path, "r") as f:
+        if not is_jsonl(path):
+            yield from json.load(f)["entries"]
+            return
+
+        f.readline()  # Key line
+        count = 0
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            record = json.loads(line)
+            if "name" not in record:
+                if record.get("count") != count:
+                    raise ValueError(f"Manifest {path} lists {count} entries, trailer says {record.get('count')}")
+                return
+            count += 1
+            yield record
+
+        raise ValueError(f"Manifest {path} is incomplete (no trailer after {count} entries)")
+
+
+def convert(src: str, dst: str) -> int:
+    """Convert between metadata.json and metadata.jsonl, returns the entry count."""
+    header = read_header(src)
+
+    if is_jsonl(dst):
+        with ManifestWriter(dst, **header) as writer:
+            for entry in iter_entries(src):
+                writer.write(entry)
+            return writer.count
+
+    entries = list(iter_entries(src))
+    with open(dst, "w") as f:
+        json.dump(dict(header, entries=entries), f, indent=2)
+    return len(entries)
+
+
+def main():
+    if len(sys.argv) != 3:
+        print("Usage: python EmeManifest.py <metadata.json|metadata.jsonl> <metadata.jsonl|metadata.json>")
+        sys.exit(1)
+
+    src, dst = sys.argv[1], sys.argv[2]
+    if not os.path.exists(src):
+        print(f"Manifest not found: {src}")
+        sys.exit(1)
+
+    count = convert(src, dst)
+    print(f"Converted {count} entries: {src} -> {dst}")
+
+
+if __name__ == "__main__":
+    main()
@@ -2,8 +2,63 @@ import os
 import struct
 import sys
 import json
+import hashlib
+import argparse
 from io import BytesIO
 import lzss
+import EmeManifest
+
+# Index fields compared against the previous dump in incremental mode
+INDEX_FIELDS = ('offset', 'packed_size', 'unpacked_size', 'lzss_frame_size', 'lzss_init_pos', 'sub_type', 'magic')
+
+# Chunk size of the user-space fallback in copy_range
+COPY_CHUNK_SIZE = 0x100000
+
+# Undo journal kept next to an archive while PkEme patches it (see PkEme.recover_archive)
+JOURNAL_SUFFIX = ".journal"
+
+
+def copy_range(src, dst, offset, count):
+    """Copy count bytes of src starting at offset to the current position of dst.
+
+    Uses os.copy_file_range or os.sendfile so the data stays in the kernel, and a buffered
+    copy for whatever they leave over: some filesystems return 0 from copy_file_range before
+    the end of the file. Stops early only at the real end of src.
+    Returns the number of bytes copied.
+    """
+    dst.flush()
+    src_fd, dst_fd = src.fileno(), dst.fileno()
+    copied = 0
+
+    for name in ('copy_file_range', 'sendfile'):
+        func = getattr(os, name, None)
+        if func is None:
+            continue
+        try:
+            while copied < count:
+                if name == 'copy_file_range':
+                    n = func(src_fd, dst_fd, count - copied, offset + copied)
+                else:
+                    n = func(dst_fd, src_fd, offset + copied, count - copied)
+                if n == 0:
+                    break  # Not necessarily EOF, the buffered copy below finishes or confirms it
+                copied += n
+            break
+        except OSError:
+            # Unsupported for this pair of files, try the next method
+            continue
+
+    # The kernel may have moved the descriptor, resync the buffered file object
+    dst.seek(os.lseek(dst_fd, 0, os.SEEK_CUR))
+
+    src.seek(offset + copied)
+    while copied < count:
+        chunk = src.read(min(COPY_CHUNK_SIZE, count - copied))
+        if not chunk:
+            break
+        dst.write(chunk)
+        copied += len(chunk)
+    return copied
 
 
 class EmeArchive:
@@ -14,6 +69,10 @@ class EmeArchive:
         self._load()
 
     def _load(self):
+        # A leftover journal means an interrupted patch, the archive may be half-written
+        if os.path.exists(self.path + JOURNAL_SUFFIX):
+            raise ValueError(f"Archive has an unfinished patch, run `PkEme.py recover {self.path}` first")
+
         with open(self.path, "rb") as f:
             # Check signature
             if f.read(4) != b"RRED":
@@ -99,17 +158,22 @@ class EmeArchive:
                     table[x] = data[k]
                 data[:] = table
 
-    def extract(self, entry):
+    def extract(self, entry, digest=None):
+        """Return the extracted data of an entry, digest is updated with the stored bytes read (see packed_hash)"""
         with open(self.path, "rb") as f:
             # Read and decrypt 12-byte header
             f.seek(entry['offset'])
             header = bytearray(f.read(12))
+            if digest:
+                digest.update(header)
             self._decrypt(header, 0, 12)
 
             # Case A — no compression
             if entry['lzss_frame_size'] == 0:
                 f.seek(entry['offset'] + 12)
                 raw = f.read(entry['packed_size'])
+                if digest:
+                    digest.update(raw)
                 return BytesIO(header + raw)
 
             # Read part2 unpacked size
@@ -123,6 +187,9 @@ class EmeArchive:
                 # Read part2 first (smaller part), then part1 (main part)
                 part2_compressed = f.read(packed_size)
                 part1_compressed = f.read(entry['packed_size'])
+                if digest:
+                    digest.update(part2_compressed)
+                    digest.update(part1_compressed)
                 
                 # Decompress in the same order as C# code
                 part2_data = lzss.decode(part2_compressed, part2_unpacked_size)
@@ -135,67 +202,239 @@ class EmeArchive:
             # Case C — normal compression (single part)
             f.seek(entry['offset'] + 12)
             compressed = f.read(entry['packed_size'])
+            if digest:
+                digest.update(compressed)
             data = lzss.decode(compressed, entry['unpacked_size'])
             return BytesIO(data)
 
-    def save_metadata(self, output_dir):
+    def extract_to(self, entry, out, digest=None):
+        """Write an extracted entry to the binary file out, digest as for extract()"""
+        if entry['lzss_frame_size'] != 0:
+            out.write(self.extract(entry, digest).read())
+            return
+
+        # Case A — no compression: only the header passes through Python
+        with open(self.path, "rb") as f:
+            f.seek(entry['offset'])
+            header = bytearray(f.read(12))
+            if digest:
+                digest.update(header)
+            self._decrypt(header, 0, 12)
+            out.write(header)
+            if not digest:
+                copy_range(f, out, entry['offset'] + 12, entry['packed_size'])
+                return
+
+            # Hashing needs the bytes in Python anyway, copy them once instead of reading twice
+            remaining = entry['packed_size']
+            while remaining > 0:
+                chunk = f.read(min(COPY_CHUNK_SIZE, remaining))
+                if not chunk:
+                    break
+                digest.update(chunk)
+                out.write(chunk)
+                remaining -= len(chunk)
+
+    @staticmethod
+    def _metadata_entry(e):
         metadata = {
+            "name": e['name'],
+            "path": "",
+            "offset": e['offset'],
+            "packed_size": e['packed_size'],
+            "unpacked_size": e['unpacked_size'],
+            "lzss_frame_size": e['lzss_frame_size'],
+            "lzss_init_pos": e['lzss_init_pos'],
+            "sub_type": e['sub_type'],
+            "magic" : e['magic'],
+            "is_packed": e['is_packed']
+        }
+        # Extracted file size/mtime and hash of the stored bytes, used by incremental extraction
+        if 'file_size' in e:
+            metadata["file_size"] = e['file_size']
+            metadata["file_mtime_ns"] = e['file_mtime_ns']
+        if e.get('packed_sha1'):
+            metadata["packed_sha1"] = e['packed_sha1']
+        return metadata
+
+    def _manifest_header(self):
+        st = os.stat(self.path)
+        return {
             "key": self.key.hex().upper(),
-            "entries": [
-                {
-                    "name": e['name'],
-                    "path": "",
-                    "offset": e['offset'],
-                    "packed_size": e['packed_size'],
-                    "unpacked_size": e['unpacked_size'],
-                    "lzss_frame_size": e['lzss_frame_size'],
-                    "lzss_init_pos": e['lzss_init_pos'],
-                    "sub_type": e['sub_type'],
-                    "magic" : e['magic'],
-                    "is_packed": e['is_packed']
-                }
-                for e in self.entries
-            ]
+            "archive_size": st.st_size,
+            "archive_mtime_ns": st.st_mtime_ns,
         }
 
-        with open(os.path.join(output_dir, "metadata.json"), "w") as f:
+    def save_metadata(self, output_dir):
+        metadata = self._manifest_header()
+        metadata["entries"] = [self._metadata_entry(e) for e in self.entries]
+
+        with open(os.path.join(output_dir, EmeManifest.JSON_NAME), "w") as f:
             json.dump(metadata, f, indent=2)
 
-    def extract_all(self, output_dir):
+    def packed_hash(self, entry):
+        """SHA-1 of the stored bytes extract() reads for an entry, without decoding them"""
+        with open(self.path, "rb") as f:
+            f.seek(entry['offset'])
+            header = f.read(12)
+            length = entry['packed_size']
+
+            if entry['lzss_frame_size'] != 0:
+                # Case B also reads the part stored ahead of packed_size
+                plain = bytearray(header)
+                self._decrypt(plain, 0, 12)
+                part2_unpacked_size = struct.unpack_from("<I", plain, 4)[0]
+                if part2_unpacked_size != 0 and part2_unpacked_size < entry['unpacked_size']:
+                    length += struct.unpack_from("<I", plain, 0)[0]
+
+            digest = hashlib.sha1(header)
+            while length > 0:
+                chunk = f.read(min(COPY_CHUNK_SIZE, length))
+                if not chunk:
+                    break
+                digest.update(chunk)
+                length -= len(chunk)
+        return digest.hexdigest()
+
+    def _load_previous(self, output_dir, manifest):
+        """Return (header, entries by name) of a previous dump in output_dir, empty if there is none"""
+        names = [EmeManifest.JSON_NAME, EmeManifest.JSONL_NAME]
+        if manifest == "jsonl":
+            names.reverse()
+
+        for name in names:
+            path = os.path.join(output_dir, name)
+            if not os.path.exists(path):
+                continue
+            try:
+                header = EmeManifest.read_header(path)
+                if header["key"].upper() != self.key.hex().upper():
+                    return {}, {}
+                return header, {e['name']: e for e in EmeManifest.iter_entries(path)}
+            except (ValueError, KeyError):
+                print(f"Ignoring unreadable {name}")
+                return {}, {}
+        return {}, {}
+
+    def _is_unchanged(self, entry, previous, output_path, archive_changed):
+        """Whether the file from the previous dump is still current, sets entry['packed_sha1']"""
+        if previous is None or any(previous.get(field) != entry[field] for field in INDEX_FIELDS):
+            return False
+        try:
+            st = os.stat(output_path)
+        except OSError:
+            return False
+        if st.st_size != previous.get('file_size') or st.st_mtime_ns != previous.get('file_mtime_ns'):
+            return False
+
+        if not archive_changed:
+            # Dumps made before hashes were recorded get theirs filled in once
+            entry['packed_sha1'] = previous.get('packed_sha1') or self.packed_hash(entry)
+            return True
+
+        # The archive was rewritten (e.g. patched in place), identical index fields prove nothing
+        entry['packed_sha1'] = self.packed_hash(entry)
+        return entry['packed_sha1'] == previous.get('packed_sha1')
+
+    def extract_all(self, output_dir, manifest="json", incremental=False, prune=False):
         os.makedirs(output_dir, exist_ok=True)
-        self.save_metadata(output_dir)
-        print(f"Created metadata.json")
-
-        for entry in self.entries:
-            stream = self.extract(entry)
-            output_path = os.path.join(output_dir, entry['name'])
-            os.makedirs(os.path.dirname(output_path), exist_ok=True)
-
-            with open(output_path, "wb") as f:
-                f.write(stream.read())
 
-            print(f"Extracted: {entry['name']}")
-
-
-def main():
-    if len(sys.argv) != 3:
-        print("Usage: python eme_opener.py <archive_path> <output_directory>")
-        sys.exit(1)
-
-    archive_path = sys.argv[1]
-    output_dir = sys.argv[2]
-
-    if not os.path.exists(archive_path):
-        print(f"Archive file not found: {archive_path}")
-        sys.exit(1)
+        # Read the previous dump before its manifest gets overwritten
+        previous_header, previous = {}, {}
+        if incremental or prune:
+            previous_header, previous = self._load_previous(output_dir, manifest)
+
+        header = self._manifest_header()
+        archive_changed = any(previous_header.get(field) != header[field]
+                              for field in ('archive_size', 'archive_mtime_ns'))
+
+        writer = None
+        if manifest == "jsonl":
+            # Entries are appended as they are extracted
+            writer = EmeManifest.ManifestWriter(os.path.join(output_dir, EmeManifest.JSONL_NAME), **header)
+            print(f"Writing {EmeManifest.JSONL_NAME}")
+
+        skipped = 0
+        try:
+            for entry in self.entries:
+                output_path = os.path.join(output_dir, entry['name'])
+
+                if incremental and self._is_unchanged(entry, previous.get(entry['name']), output_path,
+                                                       archive_changed):
+                    skipped += 1
+                else:
+                    os.makedirs(os.path.dirname(output_path), exist_ok=True)
+
+                    # Hashes are only needed to compare against later incremental runs
+                    digest = hashlib.sha1() if incremental else None
+                    with open(output_path, "wb") as f:
+                        self.extract_to(entry, f, digest)
+                    if digest:
+                        entry['packed_sha1'] = digest.hexdigest()
+                    print(f"Extracted: {entry['name']}")
+
+                st = os.stat(output_path)
+                entry['file_size'] = st.st_size
+                entry['file_mtime_ns'] = st.st_mtime_ns
+                if writer:
+                    writer.write(self._metadata_entry(entry))
+            if writer:
+                writer.finish()
+        finally:
+            # Without the trailer an interrupted dump is not mistaken for a complete one
+            if writer:
+                writer.close()
+
+        if not writer:
+            # Written last so an interrupted run leaves the previous manifest in place
+            self.save_metadata(output_dir)
+            print(f"Created {EmeManifest.JSON_NAME}")
+
+        if incremental:
+            print(f"Unchanged: {skipped}")
+
+        if prune:
+            current = {e['name'] for e in self.entries}
+            for name in previous.keys() - current:
+                path = os.path.join(output_dir, name)
+                if os.path.exists(path):
+                    os.remove(path)
+                    print(f"Removed: {name}")
+
+
+def add_arguments(parser: argparse.ArgumentParser) -> None:
+    """Add the extract arguments, shared by main() and emon.py extract."""
+    parser.add_argument('archive_path', help='EME archive to extract')
+    parser.add_argument('output_dir', help='Output directory')
+    parser.add_argument('--manifest', choices=['json', 'jsonl'], default='json',
+                        help='Manifest format: metadata.json (default) or streamed metadata.jsonl')
+    parser.add_argument('--incremental', action='store_true',
+                        help='Only extract entries that changed since the last dump in output_dir')
+    parser.add_argument('--prune', action='store_true',
+                        help='Delete files of entries from the previous dump that are no longer in the archive')
+
+
+def run(args) -> int:
+    """Extract with parsed add_arguments() arguments, returns the exit code."""
+    if not os.path.exists(args.archive_path):
+        print(f"Archive file not found: {args.archive_path}")
+        return 1
 
     try:
-        archive = EmeArchive(archive_path)
-        archive.extract_all(output_dir)
+        archive = EmeArchive(args.archive_path)
+        archive.extract_all(args.output_dir, manifest=args.manifest,
+                            incremental=args.incremental, prune=args.prune)
         print("Extraction completed.")
     except Exception as e:
         print(f"Error: {e}")
-        sys.exit(1)
+        return 1
+    return 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Extract an EME archive')
+    add_arguments(parser)
+    sys.exit(run(parser.parse_args()))
 
 
 if __name__ == "__main__":
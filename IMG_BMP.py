@@ -1,9 +1,17 @@
 #Can be used to extarct the image archives and converts them to pngs.
+#PIL and NumPy are only imported by the code paths that need them.
 
+from __future__ import annotations
+
+import json
 import struct
-from PIL import Image
 from pathlib import Path
-from lzss import decompress
+from typing import TYPE_CHECKING
+import lzss
+from ExEme import JOURNAL_SUFFIX
+
+if TYPE_CHECKING:
+    from PIL import Image
 
 class EmeError(Exception):
     pass
@@ -29,6 +37,103 @@ class EmEntry:
             end = offset + max_length
         return data[offset:end].decode('ascii')
 
+class EmImage:
+    """Header metadata and undecoded pixel rows of a sub_type 4 entry"""
+
+    def __init__(self, name: str, bpp: int, width: int, height: int, stride: int,
+                 offset_x: int, offset_y: int, palette: list, pixels: bytearray):
+        self.name = name
+        self.bpp = bpp
+        self.width = width
+        self.height = height
+        self.stride = stride
+        self.offset_x = offset_x
+        self.offset_y = offset_y
+        self.palette = palette
+        self.pixels = pixels
+
+    @property
+    def channels(self) -> int:
+        if self.bpp == 32:
+            return 4
+        if self.bpp == 24:
+            return 3
+        if self.bpp == 7 or self.palette:
+            return 1
+        raise EmeDecodingError("Unsupported image format")
+
+    def rows(self) -> tuple:
+        """Return (pixel bytes zero-filled to whole rows, stride between rows), shared by to_array and PIL"""
+        stride = max(self.stride, self.width * self.channels)
+        size = stride * self.height
+        return bytes(self.pixels[:size]).ljust(size, b'\0'), stride
+
+    def to_array(self):
+        """Return the pixels as a top-down uint8 NumPy array (RGB/RGBA order, palette indices or grey)"""
+        import numpy as np
+
+        channels = self.channels
+        data, stride = self.rows()
+        rows = np.frombuffer(data, dtype=np.uint8).reshape(self.height, stride)
+        pixels = rows[:, :self.width * channels].reshape(self.height, self.width, channels)
+        if self.bpp == 32:
+            pixels = pixels[..., [2, 1, 0, 3]]
+        elif self.bpp == 24:
+            pixels = pixels[..., ::-1]
+        if self.bpp != 7:
+            pixels = pixels[::-1]
+
+        if channels == 1:
+            pixels = pixels[..., 0]
+        return np.ascontiguousarray(pixels)
+
+    def info(self) -> dict:
+        return {
+            'name': self.name,
+            'bpp': self.bpp,
+            'width': self.width,
+            'height': self.height,
+            'offset_x': self.offset_x,
+            'offset_y': self.offset_y,
+            'palette': [list(rgb) for rgb in self.palette] if self.palette else None,
+        }
+
+class ImageStore:
+    """Read-only view of an export_arrays() dump, any image loads in O(1) from the memory map"""
+    DATA_NAME = 'images.bin'
+    INDEX_NAME = 'images.json'
+
+    def __init__(self, directory: Path):
+        import numpy as np
+
+        directory = Path(directory)
+        with open(directory / self.INDEX_NAME, 'r') as f:
+            self.index = {item['name']: item for item in json.load(f)['images']}
+        self._data = None
+        if any(item['size'] for item in self.index.values()):
+            self._data = np.memmap(directory / self.DATA_NAME, dtype=np.uint8, mode='r')
+
+    @property
+    def names(self) -> list:
+        return list(self.index)
+
+    def __len__(self) -> int:
+        return len(self.index)
+
+    def __contains__(self, name: str) -> bool:
+        return name in self.index
+
+    def __getitem__(self, name: str):
+        item = self.index[name]
+        if not item['size']:
+            # Nothing was written for it, and the data file may not even be mapped
+            import numpy as np
+            return np.zeros(item['shape'], dtype=np.uint8)
+        return self._data[item['offset']:item['offset'] + item['size']].reshape(item['shape'])
+
+    def info(self, name: str) -> dict:
+        return self.index[name]
+
 class EmeArchive:
     SIGNATURE = b'RRED'
     HEADER_SIZE = 32
@@ -39,6 +144,10 @@ class EmeArchive:
         self.entries: list[EmEntry] = []
 
     def open(self) -> bool:
+        if Path(str(self.filepath) + JOURNAL_SUFFIX).exists():
+            print(f"Archive has an unfinished patch, run `PkEme.py recover {self.filepath}` first")
+            return False
+
         try:
             with open(self.filepath, 'rb') as f:
                 if f.read(4) != self.SIGNATURE or f.read(4) != b'ATA ':
@@ -136,7 +245,44 @@ class EmeArchive:
                 except (IOError, EmeError, struct.error) as e:
                     print(f"Error extracting {entry.name}: {e}")
 
-    def _decode_image(self, data: bytes, entry: EmEntry) -> Image.Image:
+    def iter_arrays(self):
+        """Yield (EmImage, NumPy array) for every sub_type 4 entry, without going through PIL"""
+        with open(self.filepath, 'rb') as f:
+            for entry in self.entries:
+                if entry.sub_type != 4:
+                    continue
+                try:
+                    f.seek(entry.offset)
+                    image = self._decode_pixels(f.read(entry.size + self.HEADER_SIZE), entry)
+                    yield image, image.to_array()
+                except (IOError, EmeError, struct.error) as e:
+                    print(f"Error decoding {entry.name}: {e}")
+
+    def export_arrays(self, output_dir: Path) -> int:
+        """Write every image into one flat pixel file plus a JSON index, readable with ImageStore"""
+        output_dir = Path(output_dir)
+        output_dir.mkdir(parents=True, exist_ok=True)
+        alignment = 64
+        images = []
+        offset = 0
+
+        with open(output_dir / ImageStore.DATA_NAME, 'wb') as out:
+            for image, pixels in self.iter_arrays():
+                padding = -offset % alignment
+                out.write(b'\0' * padding)
+                offset += padding
+
+                out.write(pixels.tobytes())
+                item = image.info()
+                item.update(offset=offset, size=pixels.nbytes, shape=list(pixels.shape))
+                images.append(item)
+                offset += pixels.nbytes
+
+        with open(output_dir / ImageStore.INDEX_NAME, 'w') as f:
+            json.dump({'dtype': 'uint8', 'images': images}, f, indent=2)
+        return len(images)
+
+    def _decode_pixels(self, data: bytes, entry: EmEntry) -> EmImage:
         try:
             if len(data) < self.HEADER_SIZE:
                 raise EmeDecodingError("Failed to decode header")
@@ -161,20 +307,36 @@ class EmeArchive:
             pixel_data = bytearray(stride * height)
             if entry.lzss_frame_size != 0:
                 compressed_data = data[data_offset:data_offset + entry.size - data_offset]
-                decompressed_data,_ = decompress(compressed_data)
+                decompressed_data = lzss.decode(compressed_data, max(len(pixel_data), entry.unpacked_size))
                 pixel_data[:len(decompressed_data)] = decompressed_data
             else:
                 pixel_data_size = min(len(data) - data_offset, len(pixel_data))
                 pixel_data[:pixel_data_size] = data[data_offset:data_offset + pixel_data_size]
 
+            return EmImage(entry.name, bpp, width, height, stride, offset_x, offset_y, palette, pixel_data)
+
+        except (struct.error, ValueError, IOError) as e:
+            raise EmeDecodingError(f"Image decoding error: {e}")
+
+    def _decode_image(self, data: bytes, entry: EmEntry) -> Image.Image:
+        from PIL import Image
+
+        image = self._decode_pixels(data, entry)
+        bpp = image.bpp
+        width, height = image.width, image.height
+        palette = image.palette
+
+        try:
+            # Rows are stride bytes apart, padding included
+            pixel_data, stride = image.rows()
             if bpp == 7:
-                img = Image.frombytes('L', (width, height), bytes(pixel_data), 'raw', 'L')
+                img = Image.frombytes('L', (width, height), pixel_data, 'raw', 'L', stride)
             elif bpp == 32:
-                img = Image.frombytes('RGBA', (width, height), bytes(pixel_data), 'raw', 'BGRA')
+                img = Image.frombytes('RGBA', (width, height), pixel_data, 'raw', 'BGRA', stride)
             elif bpp == 24:
-                img = Image.frombytes('RGB', (width, height), bytes(pixel_data), 'raw', 'BGR')
+                img = Image.frombytes('RGB', (width, height), pixel_data, 'raw', 'BGR', stride)
             elif palette:
-                img = Image.frombytes('P', (width, height), bytes(pixel_data), 'raw', 'P')
+                img = Image.frombytes('P', (width, height), pixel_data, 'raw', 'P', stride)
                 img.putpalette([x for rgb in palette for x in rgb])
             else:
                 raise EmeDecodingError("Unsupported image format")
@@ -193,25 +355,40 @@ class EmeArchive:
             palette.append((r, g, b))
         return palette
 
-def main():
-    import sys
-    
-    if len(sys.argv) != 3:
-        print("Usage: python eme_extract.py <archive.eme> <output_directory>")
-        sys.exit(1)
-    
-    archive_path = Path(sys.argv[1])
+def add_arguments(parser) -> None:
+    """Add the image extraction arguments, shared by main() and emon.py images."""
+    parser.add_argument('archive', help='EME image archive')
+    parser.add_argument('output_dir', help='Output directory')
+    parser.add_argument('--arrays', action='store_true',
+                        help='Write images.bin + images.json (raw pixels, see ImageStore) instead of PNGs')
+
+def run(args) -> int:
+    """Extract images with parsed add_arguments() arguments, returns the exit code."""
+    archive_path = Path(args.archive)
     if not archive_path.exists():
         print(f"Archive file not found: {archive_path}")
-        sys.exit(1)
+        return 1
     
     archive = EmeArchive(archive_path)
     if not archive.open():
         print("Failed to open archive")
-        sys.exit(1)
+        return 1
     
-    archive.extract(Path(sys.argv[2]))
+    if args.arrays:
+        count = archive.export_arrays(Path(args.output_dir))
+        print(f"Exported {count} images")
+    else:
+        archive.extract(Path(args.output_dir))
     print("Extraction complete!")
+    return 0
+
+def main():
+    import sys
+    import argparse
+    
+    parser = argparse.ArgumentParser(description='Extract images from an EME archive')
+    add_arguments(parser)
+    sys.exit(run(parser.parse_args()))
 
 if __name__ == '__main__':
     main()
@@ -1,9 +1,63 @@
 import os
-import json
+import sys
+import math
+import time
 import struct
+import hashlib
 import argparse
-from typing import List, Dict
+from typing import Dict, Iterable
 import lzss
+import EmeManifest
+from ExEme import EmeArchive, copy_range, JOURNAL_SUFFIX
+
+# Adaptive mode: sample size and the entropy (bits per byte) above which LZSS is skipped
+ENTROPY_SAMPLE_SIZE = 0x10000
+ENTROPY_STORE_THRESHOLD = 7.5
+
+# Scripts (sub_type 3) start with a 12-byte encrypted header that packed_size does not count
+SCRIPT_HEADER_SIZE = 12
+
+# Index fields that describe the stored payload, shared by deduplicated entries
+PAYLOAD_FIELDS = ('offset', 'packed_size', 'unpacked_size', 'lzss_frame_size', 'lzss_init_pos', 'is_packed')
+
+# Undo journal kept next to an archive while it is being patched
+JOURNAL_MAGIC = b"EMEJRNL1"
+
+
+def _fsync_dir(path: str) -> None:
+    """Make a rename or removal in the directory holding path durable"""
+    if os.name == 'nt':
+        return  # Directories cannot be opened for fsync on Windows
+    fd = os.open(os.path.dirname(os.path.abspath(path)), os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def recover_archive(archive_path: str) -> bool:
+    """Roll back an interrupted patch using its undo journal, returns True if one was applied"""
+    journal_path = archive_path + JOURNAL_SUFFIX
+    if not os.path.exists(journal_path):
+        return False
+
+    with open(journal_path, 'rb') as journal:
+        if journal.read(8) != JOURNAL_MAGIC:
+            raise ValueError(f"Invalid journal: {journal_path}")
+        original_size, count = struct.unpack("<QI", journal.read(12))
+
+        with open(archive_path, 'r+b') as archive:
+            for _ in range(count):
+                offset, length = struct.unpack("<QI", journal.read(12))
+                archive.seek(offset)
+                archive.write(journal.read(length))
+            archive.truncate(original_size)
+            archive.flush()
+            os.fsync(archive.fileno())
+
+    os.remove(journal_path)
+    _fsync_dir(journal_path)
+    return True
 
 class EmePacker:
     def __init__(self):
@@ -94,98 +148,329 @@ class EmePacker:
             table[i] = buffer[x]
         buffer[:] = table
         
-    def create_archive(self, input_dir: str, json_path: str, output_path: str) -> bool:
+    def create_archive(self, input_dir: str, json_path: str, output_path: str,
+                       dedup: bool = False, adaptive: bool = False) -> bool:
+        archive = None
         try:
-            with open(json_path, 'r') as f:
-                archive_info = json.load(f)
-            
-            key = bytes.fromhex(archive_info['key'])
-            entries = archive_info['entries']
+            # metadata.jsonl is streamed entry by entry, metadata.json is loaded whole
+            key = bytes.fromhex(EmeManifest.read_key(json_path))
             
             processed_entries = []
-            file_data = []
             current_offset = 8
+
+            # Dedup: (content hash, sub_type, frame size) -> first entry stored with that content
+            stored = {}
+            dedup_count = 0
+            dedup_bytes = 0
+
+            # Adaptive: script entries judged incompressible are stored raw
+            raw_count = 0
+            raw_bytes = 0
+            sample_time = 0.0
+            # Trial LZSS encodes of the sampled prefixes of raw-stored entries, to measure the savings
+            trial_in = 0
+            trial_out = 0
+            trial_time = 0.0
             
-            for entry in entries:
+            archive = open(output_path, 'wb')
+            archive.write(self.signature)
+
+            for entry in EmeManifest.iter_entries(json_path):
                 input_path = os.path.join(input_dir, entry['name'])
                 if not os.path.exists(input_path):
                     print(f"Warning: Input file not found: {input_path}")
                     continue
+
+                if not dedup and entry['sub_type'] != 3:
+                    # Raw payloads never need to enter Python past their header
+                    packed_size = self._write_passthrough(input_path, entry, key, archive)
+                    entry_copy = entry.copy()
+                    entry_copy['offset'] = current_offset
+                    entry_copy['packed_size'] = packed_size
+                    processed_entries.append(entry_copy)
+                    current_offset += packed_size
+                    continue
                 
                 with open(input_path, 'rb') as f:
                     data = f.read()
+
+                if dedup:
+                    digest = (hashlib.sha1(data).digest(), entry['sub_type'], entry['lzss_frame_size'])
+                    if digest in stored:
+                        # Identical payload already written, point this entry at it
+                        entry_copy = entry.copy()
+                        for field in PAYLOAD_FIELDS:
+                            entry_copy[field] = stored[digest][field]
+                        processed_entries.append(entry_copy)
+                        dedup_count += 1
+                        dedup_bytes += entry_copy['packed_size'] + self._header_size(entry)
+                        continue
                 
-                # Handle different file types
-                if entry['sub_type'] == 3:
-                    processed_data = self._pack_script(data, entry, key)
-                # elif entry['sub_type'] == 4:
-                    # processed_data = self._pack_bmp(data, entry, key)
-                elif entry['sub_type'] == 5 and len(data) > 4:
-                    processed_data = self._pack_type5(data, key)
-                else:
-                    processed_data = data  # Default case
+                if (entry['sub_type'] == 3 and adaptive and entry['lzss_frame_size']
+                        and len(data) >= SCRIPT_HEADER_SIZE):
+                    start = time.perf_counter()
+                    incompressible = self._is_incompressible(data)
+                    sample_time += time.perf_counter() - start
+                    if incompressible:
+                        entry = dict(entry, lzss_frame_size=0, lzss_init_pos=0,
+                                     unpacked_size=len(data), is_packed=False)
+                        raw_count += 1
+                        raw_bytes += len(data)
+
+                        sample = data[:ENTROPY_SAMPLE_SIZE]
+                        start = time.perf_counter()
+                        trial = lzss.encode(sample, len(sample) * 2 + 1024)
+                        trial_time += time.perf_counter() - start
+                        trial_in += len(sample)
+                        trial_out += len(trial)
+
+                processed_data = self._process_entry(data, entry, key)
                 
                 entry_copy = entry.copy()
                 entry_copy['offset'] = current_offset
-                entry_copy['packed_size'] = len(processed_data)
+                entry_copy['packed_size'] = len(processed_data) - self._header_size(entry)
                 processed_entries.append(entry_copy)
                 
-                file_data.append(processed_data)
+                # Payloads go straight to disk instead of being buffered
+                archive.write(processed_data)
+                if dedup:
+                    stored[digest] = entry_copy
                 current_offset += len(processed_data)
             
-            # Build index entries - FIXED VERSION
             index = bytearray()
             for entry in processed_entries:
-                # Reverse LZSS init pos correction before writing
-                lzss_init_pos = entry['lzss_init_pos']
-                if entry['lzss_frame_size'] != 0:
-                    lzss_init_pos = (entry['lzss_frame_size'] - lzss_init_pos) % entry['lzss_frame_size']
-                
-                entry_data = bytearray(0x60)
-                name_bytes = entry['name'].encode('ascii')
-
-                struct.pack_into("64s", entry_data, 0x00, name_bytes)
-                struct.pack_into("<H", entry_data, 0x40, entry['lzss_frame_size'])
-                struct.pack_into("<H", entry_data, 0x42, lzss_init_pos)
-                struct.pack_into("<I", entry_data, 0x44, entry['magic'])  # ADDED THIS
-                struct.pack_into("<H", entry_data, 0x48, entry['sub_type'])  # Changed from <I to <H
-                struct.pack_into("<I", entry_data, 0x4C, entry['packed_size'])
-                struct.pack_into("<I", entry_data, 0x50, entry['unpacked_size'])
-                struct.pack_into("<I", entry_data, 0x54, entry['offset'])
-
-                encrypted_entry = self.encrypt(entry_data, 0, len(entry_data), key)
-                index.extend(encrypted_entry)  # Use encrypted entry
+                index.extend(self._index_entry(entry, key))
             
-            # Write archive
-            with open(output_path, 'wb') as archive:
-                archive.write(self.signature)
-                for data in file_data:
-                    archive.write(data)
+            # Write key, index and count after the payloads
+            with archive:
                 archive.write(key)
                 archive.write(index)
                 archive.write(struct.pack("<I", len(processed_entries)))
             
             print(f"Successfully created archive: {output_path}")
             print(f"Total files packed: {len(processed_entries)}")
+            if dedup:
+                print(f"Deduplicated entries: {dedup_count} ({dedup_bytes} bytes not stored)")
+            if adaptive:
+                print(f"Stored raw: {raw_count} entries, {raw_bytes} bytes (entropy sampling took {sample_time:.3f}s)")
+                if trial_in:
+                    # Measured on the samples and scaled up to the whole entries
+                    scale = raw_bytes / trial_in
+                    print(f"LZSS on the {trial_in} sampled bytes: {trial_out} bytes in {trial_time:.3f}s, "
+                          f"storing raw saved about {round((trial_out - trial_in) * scale)} bytes "
+                          f"and {trial_time * scale:.3f}s of encoding")
             return True
             
         except Exception as e:
+            if archive is not None:
+                # Payloads are streamed out, do not leave a partial archive behind
+                archive.close()
+                os.remove(output_path)
             print(f"Error creating archive: {str(e)}")
             import traceback
             traceback.print_exc()
             return False
 
+    def patch_archive(self, archive_path: str, input_dir: str, names: Iterable[str]) -> bool:
+        """Replace entries of an existing archive without rebuilding it.
+
+        A new payload is written over the old one when it fits and no other entry shares
+        the slot, otherwise it is appended after the last payload. The key, index and count
+        are then rewritten and the file truncated. The original bytes of every region that
+        gets overwritten are saved to an undo journal first, so an interrupted patch is
+        rolled back by recover_archive, right away when the patch fails and otherwise
+        (e.g. after a crash) on the next patch or recover.
+        """
+        journaled = False
+        try:
+            if recover_archive(archive_path):
+                print(f"Rolled back interrupted patch of {archive_path}")
+
+            eme = EmeArchive(archive_path)
+            key = eme.key
+            count = len(eme.entries)
+            file_size = os.path.getsize(archive_path)
+            index_offset = file_size - 4 - count * 0x60
+            tail_start = index_offset - 40  # End of the payloads
+
+            with open(archive_path, 'rb') as f:
+                f.seek(index_offset)
+                index = bytearray(f.read(count * 0x60))
+
+            positions = {e['name']: i for i, e in enumerate(eme.entries)}
+            slot_users = {}
+            for e in eme.entries:
+                slot_users[e['offset']] = slot_users.get(e['offset'], 0) + 1
+
+            writes = []
+            append_offset = tail_start
+            for name in dict.fromkeys(names):
+                if name not in positions:
+                    print(f"Warning: Entry not in archive: {name}")
+                    continue
+                input_path = os.path.join(input_dir, name)
+                if not os.path.exists(input_path):
+                    print(f"Warning: Input file not found: {input_path}")
+                    continue
+
+                with open(input_path, 'rb') as f:
+                    data = f.read()
+
+                i = positions[name]
+                old = eme.entries[i]
+                entry = dict(old, unpacked_size=len(data))
+                payload = self._process_entry(data, entry, key)
+
+                header_size = self._header_size(entry)
+                if len(payload) <= old['packed_size'] + header_size and slot_users[old['offset']] == 1:
+                    entry['offset'] = old['offset']
+                else:
+                    entry['offset'] = append_offset
+                    append_offset += len(payload)
+                entry['packed_size'] = len(payload) - header_size
+
+                # Only the size and offset fields change, every other byte of the entry is kept.
+                # Unchanged index entries keep their encrypted bytes.
+                raw = bytearray(index[i * 0x60:(i + 1) * 0x60])
+                eme._decrypt(raw, 0, 0x60)
+                struct.pack_into("<I", raw, 0x4C, entry['packed_size'])
+                struct.pack_into("<I", raw, 0x50, entry['unpacked_size'])
+                struct.pack_into("<I", raw, 0x54, entry['offset'])
+                index[i * 0x60:(i + 1) * 0x60] = self.encrypt(raw, 0, 0x60, key)
+                writes.append((entry['offset'], payload))
+                print(f"Patched: {name} ({'in place' if entry['offset'] == old['offset'] else 'appended'})")
+
+            if not writes:
+                print("Nothing to patch")
+                return True
+
+            tail = key + index + struct.pack("<I", count)
+            new_size = append_offset + len(tail)
+
+            # Undo journal: original bytes of overwritten slots and of the old tail
+            regions = [(offset, len(payload)) for offset, payload in writes if offset < tail_start]
+            regions.append((tail_start, file_size - tail_start))
+            journal_path = archive_path + JOURNAL_SUFFIX
+            with open(archive_path, 'rb') as archive, open(journal_path + ".tmp", 'wb') as journal:
+                journal.write(JOURNAL_MAGIC)
+                journal.write(struct.pack("<QI", file_size, len(regions)))
+                for offset, length in regions:
+                    archive.seek(offset)
+                    journal.write(struct.pack("<QI", offset, length))
+                    journal.write(archive.read(length))
+                journal.flush()
+                os.fsync(journal.fileno())
+            # Only a complete journal is ever visible to recover_archive, and its directory
+            # entry must be on disk before the archive is touched
+            os.replace(journal_path + ".tmp", journal_path)
+            _fsync_dir(journal_path)
+            journaled = True
+
+            with open(archive_path, 'r+b') as archive:
+                for offset, payload in writes:
+                    archive.seek(offset)
+                    archive.write(payload)
+                archive.seek(append_offset)
+                archive.write(tail)
+                archive.truncate(new_size)
+                archive.flush()
+                os.fsync(archive.fileno())
+
+            os.remove(journal_path)
+            _fsync_dir(journal_path)
+
+            print(f"Successfully patched archive: {archive_path}")
+            print(f"Entries patched: {len(writes)}, size {file_size} -> {new_size}")
+            return True
+
+        except Exception as e:
+            print(f"Error patching archive: {str(e)}")
+            import traceback
+            traceback.print_exc()
+            if journaled:
+                try:
+                    recover_archive(archive_path)
+                    print(f"Rolled back {archive_path}")
+                except Exception as e:
+                    print(f"Rollback failed, {archive_path + JOURNAL_SUFFIX} is kept: {str(e)}")
+            return False
+
+    @staticmethod
+    def _header_size(entry: Dict) -> int:
+        """Bytes at the start of a payload that packed_size leaves out"""
+        return SCRIPT_HEADER_SIZE if entry['sub_type'] == 3 else 0
+
+    def _process_entry(self, data: bytes, entry: Dict, key: bytes) -> bytes:
+        """Turn file data into the payload stored in the archive"""
+        # Handle different file types
+        if entry['sub_type'] == 3:
+            return self._pack_script(data, entry, key)
+        # elif entry['sub_type'] == 4:
+            # return self._pack_bmp(data, entry, key)
+        elif entry['sub_type'] == 5 and len(data) > 4:
+            return self._pack_type5(data, key)
+        return data  # Default case
+
+    def _write_passthrough(self, input_path: str, entry: Dict, key: bytes, archive) -> int:
+        """Write a non-script payload, same bytes as _process_entry, using copy_range for the body"""
+        size = os.path.getsize(input_path)
+        with open(input_path, 'rb') as f:
+            start = 0
+            if entry['sub_type'] == 5 and size > 4:
+                archive.write(self._pack_type5(f.read(4), key))
+                start = 4
+            copied = copy_range(f, archive, start, size - start)
+        if copied != size - start:
+            raise IOError(f"Short copy of {input_path}: {copied} of {size - start} bytes")
+        return size
+
+    def _index_entry(self, entry: Dict, key: bytes) -> bytearray:
+        """Build one encrypted 0x60-byte index entry - FIXED VERSION"""
+        # Reverse LZSS init pos correction before writing
+        lzss_init_pos = entry['lzss_init_pos']
+        if entry['lzss_frame_size'] != 0:
+            lzss_init_pos = (entry['lzss_frame_size'] - lzss_init_pos) % entry['lzss_frame_size']
+        
+        entry_data = bytearray(0x60)
+        name_bytes = entry['name'].encode('ascii')
+
+        struct.pack_into("64s", entry_data, 0x00, name_bytes)
+        struct.pack_into("<H", entry_data, 0x40, entry['lzss_frame_size'])
+        struct.pack_into("<H", entry_data, 0x42, lzss_init_pos)
+        struct.pack_into("<I", entry_data, 0x44, entry['magic'])  # ADDED THIS
+        struct.pack_into("<H", entry_data, 0x48, entry['sub_type'])  # Changed from <I to <H
+        struct.pack_into("<I", entry_data, 0x4C, entry['packed_size'])
+        struct.pack_into("<I", entry_data, 0x50, entry['unpacked_size'])
+        struct.pack_into("<I", entry_data, 0x54, entry['offset'])
+
+        return self.encrypt(entry_data, 0, len(entry_data), key)  # Use encrypted entry
+
+    @staticmethod
+    def _is_incompressible(data: bytes) -> bool:
+        """Estimate whether LZSS is worth running from the byte entropy of a prefix"""
+        sample = data[:ENTROPY_SAMPLE_SIZE]
+        if not sample:
+            return False
+
+        length = len(sample)
+        entropy = 0.0
+        for value in range(256):
+            count = sample.count(value)
+            if count:
+                p = count / length
+                entropy -= p * math.log2(p)
+        return entropy >= ENTROPY_STORE_THRESHOLD
+
     def _pack_script(self, data: bytes, entry: Dict, key: bytes) -> bytes:
         """Pack script files (sub_type 3) with optional compression"""
         header = bytearray(12)
         
         if not entry['lzss_frame_size']:
-            # No compression case
-            struct.pack_into("<I", header, 0, 0)
-            struct.pack_into("<I", header, 4, len(data))
-            struct.pack_into("<I", header, 8, 0)
-            encrypted_header = self.encrypt(header, 0, len(header), key)
-            return encrypted_header + data
+            # No compression case: the reader decrypts the first 12 bytes of the file in place
+            if len(data) < SCRIPT_HEADER_SIZE:
+                raise ValueError(f"Uncompressed script {entry.get('name', 'unknown')} is shorter than its 12-byte header")
+            encrypted_header = self.encrypt(bytearray(data[:SCRIPT_HEADER_SIZE]), 0, SCRIPT_HEADER_SIZE, key)
+            return encrypted_header + data[SCRIPT_HEADER_SIZE:]
         
         # Compression case
         buffer_size = len(data) * 2 + 1024
@@ -213,23 +498,80 @@ class EmePacker:
         encrypted_header = self.encrypt(header, 0, 4, key)
         return encrypted_header + data[4:]
 
-def main():
-    parser = argparse.ArgumentParser(description='Create EME archive from directory and JSON info')
+def add_pack_arguments(parser: argparse.ArgumentParser) -> None:
+    """Add the pack arguments, shared by main() and emon.py pack."""
     parser.add_argument('input_dir', help='Directory containing files to pack')
-    parser.add_argument('json_path', help='Path to archive info JSON file')
+    parser.add_argument('json_path', help='Path to archive info (metadata.json or metadata.jsonl)')
     parser.add_argument('output_path', help='Output EME archive path')
-    args = parser.parse_args()
+    parser.add_argument('--dedup', action='store_true',
+                        help='Store byte-identical files once and share their offset')
+    parser.add_argument('--adaptive', action='store_true',
+                        help='Store scripts raw instead of LZSS-compressing them when they look incompressible')
 
+def run_pack(args) -> int:
+    """Pack with parsed add_pack_arguments() arguments, returns the exit code."""
     if not os.path.isdir(args.input_dir):
         print(f"Error: Input directory does not exist: {args.input_dir}")
-        return
+        return 1
 
     if not os.path.exists(args.json_path):
         print(f"Error: JSON file does not exist: {args.json_path}")
-        return
+        return 1
+
+    packer = EmePacker()
+    ok = packer.create_archive(args.input_dir, args.json_path, args.output_path,
+                               dedup=args.dedup, adaptive=args.adaptive)
+    return 0 if ok else 1
+
+def add_patch_arguments(parser: argparse.ArgumentParser) -> None:
+    """Add the patch arguments, shared by main() and emon.py patch."""
+    parser.add_argument('archive_path', help='EME archive to patch')
+    parser.add_argument('input_dir', help='Directory containing the replacement files')
+    parser.add_argument('names', nargs='+', help='Entry names to replace')
+
+def run_patch(args) -> int:
+    """Patch with parsed add_patch_arguments() arguments, returns the exit code."""
+    if not os.path.exists(args.archive_path):
+        print(f"Error: Archive does not exist: {args.archive_path}")
+        return 1
 
     packer = EmePacker()
-    packer.create_archive(args.input_dir, args.json_path, args.output_path)
+    return 0 if packer.patch_archive(args.archive_path, args.input_dir, args.names) else 1
+
+def add_recover_arguments(parser: argparse.ArgumentParser) -> None:
+    """Add the recover arguments, shared by main() and emon.py recover."""
+    parser.add_argument('archive_path', help='EME archive with an unfinished patch')
+
+def run_recover(args) -> int:
+    """Roll back with parsed add_recover_arguments() arguments, returns the exit code."""
+    try:
+        if recover_archive(args.archive_path):
+            print(f"Rolled back interrupted patch of {args.archive_path}")
+        else:
+            print(f"No unfinished patch: {args.archive_path}")
+    except Exception as e:
+        print(f"Error: {e}")
+        return 1
+    return 0
+
+def main():
+    parser = argparse.ArgumentParser(description='Create or patch EME archives')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    p = commands.add_parser('pack', description='Create EME archive from directory and JSON info')
+    add_pack_arguments(p)
+    p.set_defaults(func=run_pack)
+
+    p = commands.add_parser('patch', description='Replace entries of an existing EME archive in place')
+    add_patch_arguments(p)
+    p.set_defaults(func=run_patch)
+
+    p = commands.add_parser('recover', description='Roll back an interrupted patch using its journal')
+    add_recover_arguments(p)
+    p.set_defaults(func=run_recover)
+
+    args = parser.parse_args()
+    sys.exit(args.func(args))
 
 if __name__ == "__main__":
     main()
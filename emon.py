@@ -0,0 +1,103 @@
+#Single entry point for the EME tools.
+#
+#   python emon.py extract <archive> <output_dir> [--manifest jsonl] [--incremental] [--prune]
+#   python emon.py pack <input_dir> <metadata.json|.jsonl> <output> [--dedup] [--adaptive]
+#   python emon.py patch <archive> <input_dir> <name> [<name> ...]
+#   python emon.py recover <archive>
+#   python emon.py images <archive> <output_dir> [--arrays]
+#   python emon.py list <archive>
+#   python emon.py info <archive>
+#
+#extract, pack, patch, recover and images take their arguments and implementation from
+#ExEme, PkEme and IMG_BMP (add_*arguments / run*), so the scripts and emon stay in sync.
+#Only the module of the subcommand being run is imported, so short invocations such as
+#list and info never load PIL or NumPy.
+
+import os
+import sys
+import argparse
+import importlib
+
+# name -> (module, arguments function, run function, help)
+TOOL_COMMANDS = {
+    'extract': ('ExEme', 'add_arguments', 'run', 'Extract an archive with its metadata'),
+    'pack': ('PkEme', 'add_pack_arguments', 'run_pack', 'Create an archive from a directory and its metadata'),
+    'patch': ('PkEme', 'add_patch_arguments', 'run_patch', 'Replace entries of an existing archive in place'),
+    'recover': ('PkEme', 'add_recover_arguments', 'run_recover', 'Roll back an interrupted patch'),
+    'images': ('IMG_BMP', 'add_arguments', 'run', 'Decode image entries to PNGs or a raw pixel store'),
+}
+
+
+def cmd_list(args) -> int:
+    from ExEme import EmeArchive
+
+    for e in EmeArchive(args.archive).entries:
+        print(f"{e['sub_type']:>3} {e['packed_size']:>10} {e['unpacked_size']:>10}  {e['name']}")
+    return 0
+
+
+def cmd_info(args) -> int:
+    from ExEme import EmeArchive
+
+    archive = EmeArchive(args.archive)
+    sub_types = {}
+    for e in archive.entries:
+        sub_types[e['sub_type']] = sub_types.get(e['sub_type'], 0) + 1
+
+    print(f"Archive:       {args.archive}")
+    print(f"Size:          {os.path.getsize(args.archive)}")
+    print(f"Entries:       {len(archive.entries)}")
+    print(f"Key:           {archive.key.hex().upper()}")
+    print(f"Packed size:   {sum(e['packed_size'] for e in archive.entries)}")
+    print(f"Unpacked size: {sum(e['unpacked_size'] for e in archive.entries)}")
+    print(f"Compressed:    {sum(1 for e in archive.entries if e['lzss_frame_size'])}")
+    for sub_type, count in sorted(sub_types.items()):
+        print(f"sub_type {sub_type}:    {count}")
+    return 0
+
+
+def build_parser(argv=None) -> argparse.ArgumentParser:
+    """Build the emon parser; only the subcommand named in argv gets its module's arguments."""
+    if argv is None:
+        argv = sys.argv[1:]
+    selected = next((a for a in argv if not a.startswith('-')), None)
+
+    parser = argparse.ArgumentParser(prog='emon', description='EME archive tools')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    for name, (module_name, add_arguments, run, help) in TOOL_COMMANDS.items():
+        p = commands.add_parser(name, help=help, description=help)
+        if name == selected:
+            module = importlib.import_module(module_name)
+            getattr(module, add_arguments)(p)
+            p.set_defaults(func=getattr(module, run))
+
+    p = commands.add_parser('list', help='List archive entries (sub_type, packed, unpacked, name)')
+    p.add_argument('archive', help='EME archive')
+    p.set_defaults(func=cmd_list)
+
+    p = commands.add_parser('info', help='Show archive summary')
+    p.add_argument('archive', help='EME archive')
+    p.set_defaults(func=cmd_info)
+
+    return parser
+
+
+def main(argv=None) -> int:
+    if argv is None:
+        argv = sys.argv[1:]
+    args = build_parser(argv).parse_args(argv)
+
+    if args.func in (cmd_list, cmd_info) and not os.path.exists(args.archive):
+        print(f"Archive file not found: {args.archive}")
+        return 1
+
+    try:
+        return args.func(args)
+    except Exception as e:
+        print(f"Error: {e}")
+        return 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
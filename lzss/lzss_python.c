@@ -21,8 +21,11 @@ static PyObject* py_lzss_encode(PyObject* self, PyObject* args) {
 
     uint8_t *dst = (uint8_t *)PyBytes_AS_STRING(ret);
 
-    // Call underlying C encoder
-    uint8_t *end = lzss_encode(dst, dstlen, (uint8_t *)src_buf.buf, (uint32_t)src_buf.len);
+    // Call underlying C encoder, without the GIL so other threads can run
+    uint8_t *end;
+    Py_BEGIN_ALLOW_THREADS
+    end = lzss_encode(dst, dstlen, (uint8_t *)src_buf.buf, (uint32_t)src_buf.len);
+    Py_END_ALLOW_THREADS
 
     PyBuffer_Release(&src_buf);
 
@@ -61,8 +64,11 @@ static PyObject* py_lzss_decode(PyObject* self, PyObject* args) {
 
     uint8_t *dst = (uint8_t *)PyBytes_AS_STRING(ret);
 
-    // Call C decoder
-    int result_len = lzss_decode(dst, (uint8_t *)src_buf.buf, (uint32_t)src_buf.len);
+    // Call C decoder, without the GIL so other threads can run
+    int result_len;
+    Py_BEGIN_ALLOW_THREADS
+    result_len = lzss_decode(dst, (uint8_t *)src_buf.buf, (uint32_t)src_buf.len);
+    Py_END_ALLOW_THREADS
 
     PyBuffer_Release(&src_buf);
 
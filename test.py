@@ -1,4 +1,14 @@
+import os
+import sys
+import io
+import re
+import json
+import argparse
+import contextlib
+import time
 import struct
+import tempfile
+import subprocess
 
 class Encryptor:
     def encrypt(self, buffer: bytearray, offset: int, length: int, routine: bytes) -> bytearray:
@@ -193,10 +203,739 @@ def test_known_encrypted_data():
     print()
 
 
+def _write_pack_input(input_dir, files, routine, fields=None):
+    """Write files plus a metadata.json for PkEme (uncompressed entries unless fields says otherwise)"""
+    entries = []
+    for name, (data, sub_type) in files.items():
+        with open(os.path.join(input_dir, name), "wb") as f:
+            f.write(data)
+        entry = {
+            "name": name, "path": "", "offset": 0,
+            "packed_size": len(data), "unpacked_size": len(data),
+            "lzss_frame_size": 0, "lzss_init_pos": 0,
+            "sub_type": sub_type, "magic": 0, "is_packed": False
+        }
+        entry.update((fields or {}).get(name, {}))
+        entries.append(entry)
+
+    json_path = os.path.join(input_dir, "metadata.json")
+    with open(json_path, "w") as f:
+        json.dump({"key": routine.hex().upper(), "entries": entries}, f, indent=2)
+    return json_path
+
+
+def test_jsonl_manifest():
+    """Test the JSON Lines manifest writer, the converter and packing from metadata.jsonl"""
+    print("=== Testing JSON Lines Manifest ===")
+
+    import EmeManifest
+    from PkEme import EmePacker
+    from ExEme import EmeArchive
+
+    routine = bytes.fromhex("0104020800000000f962a8ec11000000f8e296ca0700000000000000000000000000000000000000")
+    files = {f"file{i}.bin": (bytes([i]) * (100 + i), 5) for i in range(5)}
+
+    with tempfile.TemporaryDirectory() as tmp:
+        json_path = _write_pack_input(tmp, files, routine)
+        jsonl_path = os.path.join(tmp, "metadata.jsonl")
+        back_path = os.path.join(tmp, "back.json")
+
+        assert EmeManifest.convert(json_path, jsonl_path) == len(files)
+        assert EmeManifest.read_key(jsonl_path) == routine.hex().upper()
+        assert EmeManifest.convert(jsonl_path, back_path) == len(files)
+        with open(json_path) as a, open(back_path) as b:
+            assert json.load(a) == json.load(b)
+
+        packer = EmePacker()
+        from_json = os.path.join(tmp, "json.eme")
+        from_jsonl = os.path.join(tmp, "jsonl.eme")
+        assert packer.create_archive(tmp, json_path, from_json)
+        assert packer.create_archive(tmp, jsonl_path, from_jsonl)
+        with open(from_json, "rb") as a, open(from_jsonl, "rb") as b:
+            assert a.read() == b.read()
+
+        # A manifest cut short (no trailer) is rejected and no archive is left behind
+        with open(jsonl_path) as f:
+            lines = f.readlines()
+        truncated_path = os.path.join(tmp, "truncated.jsonl")
+        with open(truncated_path, "w") as f:
+            f.writelines(lines[:-2])
+        truncated_eme = os.path.join(tmp, "truncated.eme")
+        assert not packer.create_archive(tmp, truncated_path, truncated_eme)
+        assert not os.path.exists(truncated_eme)
+
+        # An interrupted writer leaves the previous manifest in place
+        writer = EmeManifest.ManifestWriter(jsonl_path, routine.hex().upper())
+        writer.write({"name": "file0.bin"})
+        writer.close()
+        assert not os.path.exists(jsonl_path + ".tmp")
+        with open(jsonl_path) as f:
+            assert f.readlines() == lines
+        assert len(list(EmeManifest.iter_entries(jsonl_path))) == len(files)
+
+        # Same for an extraction that fails halfway through a jsonl dump
+        out = os.path.join(tmp, "out")
+        archive = EmeArchive(from_jsonl)
+        archive.extract_all(out, manifest="jsonl")
+        with open(os.path.join(out, "metadata.jsonl")) as f:
+            dumped = f.read()
+        extract_to = archive.extract_to
+
+        def failing_extract_to(entry, out, digest=None):
+            if entry['name'] == "file2.bin":
+                raise OSError("simulated failure")
+            extract_to(entry, out, digest)
+
+        archive.extract_to = failing_extract_to
+        try:
+            archive.extract_all(out, manifest="jsonl")
+            assert False, "interrupted extraction succeeded"
+        except OSError:
+            pass
+        assert not os.path.exists(os.path.join(out, "metadata.jsonl.tmp"))
+        with open(os.path.join(out, "metadata.jsonl")) as f:
+            assert f.read() == dumped
+
+    print("Success: True")
+    print()
+
+
+def test_dedup_aliases():
+    """Test that deduplicated entries share one payload and still extract correctly"""
+    print("=== Testing Packer Deduplication ===")
+
+    from PkEme import EmePacker
+    from ExEme import EmeArchive
+
+    routine = bytes.fromhex("0104020800000000f962a8ec11000000f8e296ca0700000000000000000000000000000000000000")
+    shared = b"shared ui part " * 200
+    files = {
+        "ui_a.bin": (shared, 5),
+        "ui_b.bin": (shared, 5),
+        "ui_c.dat": (shared, 0),
+        "unique.bin": (b"unique payload " * 50, 5),
+    }
+
+    with tempfile.TemporaryDirectory() as tmp:
+        json_path = _write_pack_input(tmp, files, routine)
+        plain_path = os.path.join(tmp, "plain.eme")
+        dedup_path = os.path.join(tmp, "dedup.eme")
+
+        packer = EmePacker()
+        assert packer.create_archive(tmp, json_path, plain_path)
+        assert packer.create_archive(tmp, json_path, dedup_path, dedup=True)
+
+        plain = EmeArchive(plain_path)
+        dedup = EmeArchive(dedup_path)
+        offsets = {e['name']: e['offset'] for e in dedup.entries}
+
+        print(f"Archive size: {os.path.getsize(plain_path)} -> {os.path.getsize(dedup_path)}")
+        assert offsets["ui_a.bin"] == offsets["ui_b.bin"]
+        assert offsets["ui_a.bin"] != offsets["ui_c.dat"]  # Different sub_type is packed separately
+        assert os.path.getsize(dedup_path) == os.path.getsize(plain_path) - len(shared)
+
+        for plain_entry, dedup_entry in zip(plain.entries, dedup.entries):
+            # The extractor reads past packed_size for uncompressed entries, only compare the entry itself
+            size = plain_entry['packed_size']
+            assert plain.extract(plain_entry).read()[:size] == dedup.extract(dedup_entry).read()[:size]
+
+    print("Success: True")
+    print()
+
+
+def test_adaptive_raw_script():
+    """Test that a script stored raw by the adaptive packer extracts byte for byte"""
+    print("=== Testing Adaptive Raw Script ===")
+
+    import lzss
+    if not hasattr(lzss, "encode"):
+        # Only the lzss/ sources are importable, the extension is not built for this platform
+        print("Skipped: lzss extension not built")
+        print()
+        return
+
+    from PkEme import EmePacker
+    from ExEme import EmeArchive
+
+    routine = bytes.fromhex("0104020800000000f962a8ec11000000f8e296ca0700000000000000000000000000000000000000")
+    script = os.urandom(5000)
+    files = {"random.txt": (script, 3), "after.bin": (b"next payload " * 20, 5)}
+    fields = {"random.txt": {"lzss_frame_size": 0x1000, "lzss_init_pos": 0x12, "magic": 1, "is_packed": True}}
+
+    with tempfile.TemporaryDirectory() as tmp:
+        json_path = _write_pack_input(tmp, files, routine, fields)
+        archive_path = os.path.join(tmp, "adaptive.eme")
+        report = io.StringIO()
+        with contextlib.redirect_stdout(report):
+            assert EmePacker().create_archive(tmp, json_path, archive_path, adaptive=True)
+        print(report.getvalue(), end="")
+
+        # Random data grows under LZSS, the measured saving is positive
+        saved = re.search(r"storing raw saved about (-?\d+) bytes", report.getvalue())
+        assert saved and int(saved.group(1)) > 0, report.getvalue()
+
+        archive = EmeArchive(archive_path)
+        entry = archive.entries[0]
+        assert entry['lzss_frame_size'] == 0
+        assert entry['packed_size'] == len(script) - 12
+        assert entry['offset'] + 12 + entry['packed_size'] == archive.entries[1]['offset']
+        assert archive.extract(entry).read() == script
+
+    print("Success: True")
+    print()
+
+
+def test_incremental_extract():
+    """Test incremental extraction after an in-place patch, a deleted output and --prune"""
+    print("=== Testing Incremental Extraction ===")
+
+    from PkEme import EmePacker
+    import EmeManifest
+    from ExEme import EmeArchive
+
+    routine = bytes.fromhex("0104020800000000f962a8ec11000000f8e296ca0700000000000000000000000000000000000000")
+    # b.bin goes first: extract() of an uncompressed entry also reads 12 bytes of the next payload
+    files = {name: (name.encode() * 300, 5) for name in ("b.bin", "a.bin", "c.bin")}
+
+    with tempfile.TemporaryDirectory() as tmp:
+        json_path = _write_pack_input(tmp, files, routine)
+        archive_path = os.path.join(tmp, "inc.eme")
+        out = os.path.join(tmp, "out")
+        assert EmePacker().create_archive(tmp, json_path, archive_path)
+
+        def mtimes():
+            return {name: os.stat(os.path.join(out, name)).st_mtime_ns for name in files}
+
+        def expected(name):
+            archive = EmeArchive(archive_path)
+            return archive.extract(next(e for e in archive.entries if e['name'] == name)).read()
+
+        EmeArchive(archive_path).extract_all(out)
+        before = mtimes()
+
+        # A plain extract does not hash payloads
+        with open(os.path.join(out, "metadata.json")) as f:
+            assert not any("packed_sha1" in e for e in json.load(f)["entries"])
+
+        # No-op run rewrites nothing
+        EmeArchive(archive_path).extract_all(out, incremental=True)
+        assert mtimes() == before
+
+        # Same-size in-place patch keeps every index field, only the hash tells it apart
+        with open(os.path.join(tmp, "b.bin"), "wb") as f:
+            f.write(b"B.BIN" * 300)
+        assert EmePacker().patch_archive(archive_path, tmp, ["b.bin"])
+        EmeArchive(archive_path).extract_all(out, incremental=True, manifest="jsonl")
+        after = mtimes()
+        assert after["a.bin"] == before["a.bin"] and after["c.bin"] == before["c.bin"]
+        with open(os.path.join(out, "b.bin"), "rb") as f:
+            assert f.read() == expected("b.bin")
+
+        # Hashes taken while copying match the ones read back from the archive
+        archive = EmeArchive(archive_path)
+        recorded = {e['name']: e['packed_sha1'] for e in EmeManifest.iter_entries(os.path.join(out, "metadata.jsonl"))}
+        assert recorded == {e['name']: archive.packed_hash(e) for e in archive.entries}
+
+        # A missing output file is extracted again
+        os.remove(os.path.join(out, "c.bin"))
+        EmeArchive(archive_path).extract_all(out, incremental=True, manifest="jsonl")
+        assert os.path.exists(os.path.join(out, "c.bin"))
+
+        # --prune without --incremental removes files of entries that are gone
+        smaller = {name: files[name] for name in ("b.bin", "a.bin")}
+        smaller_json = _write_pack_input(tmp, smaller, routine)
+        assert EmePacker().create_archive(tmp, smaller_json, archive_path)
+        EmeArchive(archive_path).extract_all(out, manifest="jsonl", prune=True)
+        assert not os.path.exists(os.path.join(out, "c.bin"))
+        assert os.path.exists(os.path.join(out, "a.bin"))
+
+    print("Success: True")
+    print()
+
+
+def test_async_reads():
+    """Test AsyncEmeArchive coalescing, max_pending backpressure and hundreds of concurrent reads"""
+    print("=== Testing Async Reads ===")
+
+    import asyncio
+    import threading
+    from PkEme import EmePacker
+    from AsyncEme import AsyncEmeArchive
+
+    routine = bytes.fromhex("0104020800000000f962a8ec11000000f8e296ca0700000000000000000000000000000000000000")
+    files = {f"entry{i}.bin": (bytes([i]) * 4096, 5) for i in range(6)}
+
+    class SlowArchive(AsyncEmeArchive):
+        """Counts decodes and how many run at once, each one taking a while"""
+        def __init__(self, *args, **kwargs):
+            super().__init__(*args, **kwargs)
+            self.lock = threading.Lock()
+            self.calls = 0
+            self.running = 0
+            self.peak = 0
+
+        def _extract(self, entry):
+            with self.lock:
+                self.calls += 1
+                self.running += 1
+                self.peak = max(self.peak, self.running)
+            time.sleep(0.05)
+            try:
+                return super()._extract(entry)
+            finally:
+                with self.lock:
+                    self.running -= 1
+
+    async def run(archive, expected):
+        archive.calls = archive.peak = 0
+        lag = 0.0
+        done = False
+
+        async def ticker():
+            # Measures how long the event loop is blocked while decodes run
+            nonlocal lag
+            while not done:
+                start = time.perf_counter()
+                await asyncio.sleep(0.01)
+                lag = max(lag, time.perf_counter() - start - 0.01)
+
+        tick = asyncio.ensure_future(ticker())
+        names = [f"entry{i % len(files)}.bin" for i in range(300)]
+        results = await asyncio.gather(*[archive.read(name) for name in names])
+        done = True
+        await tick
+
+        assert all(data == expected[name] for name, data in zip(names, results))
+        assert archive.calls == len(files), archive.calls  # One decode per distinct entry
+        assert archive.peak <= 2, archive.peak             # Never more than max_pending at once
+        assert lag < 0.5, lag
+
+        # Uncompressed entries are streamed from the file, not decoded whole
+        calls = archive.calls
+        chunks = [chunk async for chunk in archive.stream("entry1.bin", 1000)]
+        assert b"".join(chunks) == expected["entry1.bin"] and len(chunks) == 5
+        assert archive.calls == calls
+
+        try:
+            await archive.read("missing.bin")
+            assert False, "missing entry was read"
+        except KeyError:
+            pass
+
+        print(f"300 reads -> {archive.calls} decodes, peak concurrency {archive.peak}, loop lag {lag:.3f}s")
+
+    with tempfile.TemporaryDirectory() as tmp:
+        json_path = _write_pack_input(tmp, files, routine)
+        archive_path = os.path.join(tmp, "async.eme")
+        assert EmePacker().create_archive(tmp, json_path, archive_path)
+
+        from ExEme import EmeArchive
+        plain = EmeArchive(archive_path)
+        expected = {e['name']: plain.extract(e).read() for e in plain.entries}
+        archive = SlowArchive(archive_path, max_workers=8, max_pending=2)
+        try:
+            # Twice: the archive must not stay bound to the first event loop
+            for _ in range(2):
+                asyncio.run(run(archive, expected))
+        finally:
+            archive.close()
+
+    print("Success: True")
+    print()
+
+
+def _raw_index(archive_path):
+    """Decrypted 0x60-byte index entries of an archive"""
+    from ExEme import EmeArchive
+
+    archive = EmeArchive(archive_path)
+    count = len(archive.entries)
+    with open(archive_path, "rb") as f:
+        f.seek(-4 - count * 0x60, os.SEEK_END)
+        index = bytearray(f.read(count * 0x60))
+    entries = []
+    for i in range(count):
+        archive._decrypt(index, i * 0x60, 0x60)
+        entries.append(bytes(index[i * 0x60:(i + 1) * 0x60]))
+    return entries
+
+
+def test_patch_archive():
+    """Test in-place, appended and shared-slot patches and rollback of an interrupted patch"""
+    print("=== Testing Archive Patching ===")
+
+    from PkEme import EmePacker, recover_archive, JOURNAL_SUFFIX
+    from ExEme import EmeArchive
+
+    routine = bytes.fromhex("0104020800000000f962a8ec11000000f8e296ca0700000000000000000000000000000000000000")
+    shared = b"shared part " * 100
+    files = {
+        "a.bin": (b"A" * 2000, 5),
+        "b.bin": (b"B" * 2000, 5),
+        "s1.bin": (shared, 5),
+        "s2.bin": (shared, 5),
+    }
+    fields = {name: {"magic": 0x20400000} for name in files}
+
+    def contents(archive_path):
+        archive = EmeArchive(archive_path)
+        # extract() decrypts a 12-byte prefix and reads 12 bytes past the entry for sub_type 5,
+        # only data[12:] comes back verbatim
+        return {e['name']: archive.extract(e).read()[12:e['packed_size']] for e in archive.entries}
+
+    def replace(tmp, name, data):
+        with open(os.path.join(tmp, name), "wb") as f:
+            f.write(data)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        json_path = _write_pack_input(tmp, files, routine, fields)
+        archive_path = os.path.join(tmp, "patch.eme")
+        packer = EmePacker()
+        assert packer.create_archive(tmp, json_path, archive_path, dedup=True)
+        original = EmeArchive(archive_path)
+        offsets = {e['name']: e['offset'] for e in original.entries}
+        size = os.path.getsize(archive_path)
+        assert offsets["s1.bin"] == offsets["s2.bin"]
+
+        # Smaller payload: rewritten in its own slot, file size unchanged
+        replace(tmp, "a.bin", b"a" * 1500)
+        assert packer.patch_archive(archive_path, tmp, ["a.bin"])
+        patched = EmeArchive(archive_path)
+        entry = next(e for e in patched.entries if e['name'] == "a.bin")
+        assert entry['offset'] == offsets["a.bin"] and entry['packed_size'] == 1500
+        assert os.path.getsize(archive_path) == size
+        assert contents(archive_path)["a.bin"] == b"a" * 1488
+
+        # Larger payload: appended after the last payload
+        replace(tmp, "b.bin", b"b" * 3000)
+        assert packer.patch_archive(archive_path, tmp, ["b.bin"])
+        patched = EmeArchive(archive_path)
+        entry = next(e for e in patched.entries if e['name'] == "b.bin")
+        assert entry['offset'] > max(offsets.values())
+        assert os.path.getsize(archive_path) == size + 3000
+        assert contents(archive_path)["b.bin"] == b"b" * 2988
+
+        # Shared slot: the patched alias moves out, the other keeps the old bytes
+        replace(tmp, "s1.bin", b"S" * 100)
+        assert packer.patch_archive(archive_path, tmp, ["s1.bin"])
+        patched = {e['name']: e for e in EmeArchive(archive_path).entries}
+        assert patched["s1.bin"]['offset'] != offsets["s1.bin"]
+        assert patched["s2.bin"]['offset'] == offsets["s2.bin"]
+        data = contents(archive_path)
+        assert data["s1.bin"] == b"S" * 88
+        assert data["s2.bin"] == shared[12:]
+
+        # Index bytes other than sizes and offset survive, including the full 32-bit magic
+        for raw in _raw_index(archive_path):
+            assert struct.unpack_from("<I", raw, 0x44)[0] == 0x20400000
+
+        # Failed patch: the archive fsync fails once, the patch is rolled back right away
+        with open(archive_path, "rb") as f:
+            before = f.read()
+        archive_ino = os.stat(archive_path).st_ino
+        real_fsync = os.fsync
+        failures = []
+
+        def failing_fsync(fd):
+            if os.fstat(fd).st_ino == archive_ino and len(failures) < max_failures:
+                failures.append(fd)
+                raise OSError("simulated failure")
+            real_fsync(fd)
+
+        replace(tmp, "a.bin", b"x" * 5000)
+        max_failures = 1
+        os.fsync = failing_fsync
+        try:
+            assert not packer.patch_archive(archive_path, tmp, ["a.bin"])
+        finally:
+            os.fsync = real_fsync
+        assert not os.path.exists(archive_path + JOURNAL_SUFFIX)
+        with open(archive_path, "rb") as f:
+            assert f.read() == before
+
+        # Rollback fails too (as after a crash): the journal is kept and readers refuse the archive
+        failures.clear()
+        max_failures = 2
+        os.fsync = failing_fsync
+        try:
+            assert not packer.patch_archive(archive_path, tmp, ["a.bin"])
+        finally:
+            os.fsync = real_fsync
+        assert os.path.exists(archive_path + JOURNAL_SUFFIX)
+        try:
+            EmeArchive(archive_path)
+            assert False, "opened an archive with an unfinished patch"
+        except ValueError as e:
+            assert "unfinished patch" in str(e)
+        import IMG_BMP
+        assert not IMG_BMP.EmeArchive(archive_path).open()
+
+        assert recover_archive(archive_path)
+        assert not os.path.exists(archive_path + JOURNAL_SUFFIX)
+        with open(archive_path, "rb") as f:
+            assert f.read() == before
+        assert not recover_archive(archive_path)
+        assert len(EmeArchive(archive_path).entries) == len(files)
+
+    print("Success: True")
+    print()
+
+
+def test_copy_range_short_copies():
+    """Test that copy_range finishes a copy when the kernel copy stops returning data early"""
+    print("=== Testing copy_range Short Copies ===")
+
+    from ExEme import copy_range
+
+    data = os.urandom(300000)
+    real_copy_file_range = getattr(os, 'copy_file_range', None)
+    real_sendfile = getattr(os, 'sendfile', None)
+
+    def unsupported(*args):
+        raise OSError("not supported")
+
+    # Each copies one 1000-byte piece, then reports 0 bytes as some filesystems do before EOF
+    def stalling_copy_file_range(src, dst, count, offset_src):
+        if stalling_copy_file_range.done:
+            return 0
+        stalling_copy_file_range.done = True
+        return real_copy_file_range(src, dst, 1000, offset_src)
+
+    def stalling_sendfile(out_fd, in_fd, offset, count):
+        if stalling_sendfile.done:
+            return 0
+        stalling_sendfile.done = True
+        return real_sendfile(out_fd, in_fd, offset, 1000)
+
+    cases = []
+    if real_copy_file_range:
+        cases.append((stalling_copy_file_range, unsupported))
+    if real_sendfile:
+        cases.append((unsupported, stalling_sendfile))
+
+    with tempfile.TemporaryDirectory() as tmp:
+        src_path = os.path.join(tmp, "src.bin")
+        with open(src_path, "wb") as f:
+            f.write(data)
+
+        for copy_file_range, sendfile in cases:
+            stalling_copy_file_range.done = stalling_sendfile.done = False
+            os.copy_file_range, os.sendfile = copy_file_range, sendfile
+            try:
+                with open(src_path, "rb") as src, open(os.path.join(tmp, "dst.bin"), "w+b") as dst:
+                    dst.write(b"head")
+                    assert copy_range(src, dst, 100, len(data)) == len(data) - 100
+                    dst.write(b"tail")
+                    dst.seek(0)
+                    assert dst.read() == b"head" + data[100:] + b"tail"
+                assert stalling_copy_file_range.done or stalling_sendfile.done
+            finally:
+                os.copy_file_range, os.sendfile = real_copy_file_range, real_sendfile
+                for name in ('copy_file_range', 'sendfile'):
+                    if getattr(os, name) is None:
+                        delattr(os, name)
+
+    print("Success: True")
+    print()
+
+
+def _write_image_archive(archive_path, images, routine):
+    """Write an archive of uncompressed sub_type 4 images: name -> (bpp, width, height, colors, pixels)"""
+    from PkEme import EmePacker
+
+    packer = EmePacker()
+    body = b""
+    entries = []
+    for name, (bpp, width, height, colors, pixels) in images.items():
+        header = bytearray(32)
+        struct.pack_into("<HHHHiii", header, 0, bpp, width, height, colors, len(pixels) // max(height, 1), 3, -7)
+        palette = b"".join(bytes([i * 16 % 256, 255 - i, i * 3 % 256, 0]) for i in range(colors))
+        payload = bytes(packer.encrypt(header, 0, 32, routine)) + palette + pixels
+        entries.append({"name": name, "lzss_frame_size": 0, "lzss_init_pos": 0, "magic": 0x10, "sub_type": 4,
+                        "packed_size": len(payload), "unpacked_size": len(payload), "offset": 8 + len(body)})
+        body += payload
+
+    index = b"".join(packer._index_entry(e, routine) for e in entries)
+    with open(archive_path, "wb") as f:
+        f.write(packer.signature + body + routine + index + struct.pack("<I", len(entries)))
+
+
+def test_image_arrays():
+    """Test EmImage.to_array against the PIL path and the ImageStore round trip"""
+    print("=== Testing Image Arrays ===")
+
+    try:
+        import numpy as np
+        import PIL  # noqa: F401
+    except ImportError:
+        print("Skipped: NumPy or PIL not installed")
+        print()
+        return
+
+    from pathlib import Path
+    import IMG_BMP
+
+    routine = bytes.fromhex("0104020800000000f962a8ec11000000f8e296ca0700000000000000000000000000000000000000")
+    images = {
+        "rgba.bmp": (32, 7, 5, 0, os.urandom(7 * 4 * 5)),
+        "rgb.bmp": (24, 5, 4, 0, os.urandom(5 * 3 * 4)),
+        "paletted.bmp": (8, 6, 3, 16, bytes(i % 16 for i in range(6 * 3))),
+        # Rows padded past width * channels: 15 -> 16 and 6 -> 8 bytes
+        "padded_rgb.bmp": (24, 5, 4, 0, os.urandom(16 * 4)),
+        "padded_paletted.bmp": (8, 6, 3, 16, bytes(i % 8 for i in range(8 * 3))),
+    }
+
+    with tempfile.TemporaryDirectory() as tmp:
+        archive_path = Path(tmp) / "images.eme"
+        _write_image_archive(archive_path, images, routine)
+        archive = IMG_BMP.EmeArchive(archive_path)
+        assert archive.open()
+
+        arrays = {}
+        with open(archive_path, "rb") as f:
+            for entry in archive.entries:
+                f.seek(entry.offset)
+                pil_image = archive._decode_image(f.read(entry.size + archive.HEADER_SIZE), entry)
+                arrays[entry.name] = np.array(pil_image)
+
+        decoded = list(archive.iter_arrays())
+        assert [image.name for image, _ in decoded] == list(images)
+        for image, pixels in decoded:
+            assert pixels.dtype == np.uint8
+            assert np.array_equal(pixels, arrays[image.name]), image.name
+            assert (image.offset_x, image.offset_y) == (3, -7)
+        # Padding bytes at the end of each row are skipped by both paths
+        padded = {image.name: pixels for image, pixels in decoded}
+        rows = np.frombuffer(images["padded_rgb.bmp"][4], dtype=np.uint8).reshape(4, 16)
+        assert np.array_equal(padded["padded_rgb.bmp"], rows[::-1, :15].reshape(4, 5, 3)[..., ::-1])
+        rows = np.frombuffer(images["padded_paletted.bmp"][4], dtype=np.uint8).reshape(3, 8)
+        assert np.array_equal(padded["padded_paletted.bmp"], rows[::-1, :6])
+        paletted = next(image for image, _ in decoded if image.name == "paletted.bmp")
+        assert len(paletted.palette) == 16 and paletted.info()["palette"][1] == [3, 254, 16]
+
+        store_dir = os.path.join(tmp, "store")
+        assert archive.export_arrays(store_dir) == len(images)
+        store = IMG_BMP.ImageStore(store_dir)
+        assert sorted(store.names) == sorted(images)
+        for image, pixels in decoded:
+            assert np.array_equal(store[image.name], pixels)
+            assert store.info(image.name)["bpp"] == image.bpp
+            assert store.info(image.name)["offset"] % 64 == 0
+
+        # An archive whose images are all empty still reads back
+        empty_path = Path(tmp) / "empty.eme"
+        _write_image_archive(empty_path, {"empty.bmp": (32, 4, 0, 0, b"")}, routine)
+        empty = IMG_BMP.EmeArchive(empty_path)
+        assert empty.open()
+        empty_dir = Path(tmp) / "empty_store"
+        assert empty.export_arrays(empty_dir) == 1
+        assert IMG_BMP.ImageStore(empty_dir)["empty.bmp"].shape == (0, 4, 4)
+
+    print("Success: True")
+    print()
+
+
+# Wall-clock budget for one `emon list` process on a small archive
+EMON_STARTUP_BUDGET = 1.0
+
+
+def test_emon_list_startup():
+    """Test that `emon list` stays within the startup budget and never loads PIL or NumPy"""
+    print("=== Testing emon list Startup ===")
+
+    from PkEme import EmePacker
+
+    routine = bytes.fromhex("0104020800000000f962a8ec11000000f8e296ca0700000000000000000000000000000000000000")
+    files = {f"file{i}.bin": (bytes([i]) * 256, 5) for i in range(8)}
+    repo = os.path.dirname(os.path.abspath(__file__))
+    emon = os.path.join(repo, "emon.py")
+
+    with tempfile.TemporaryDirectory() as tmp:
+        json_path = _write_pack_input(tmp, files, routine)
+        archive_path = os.path.join(tmp, "small.eme")
+        assert EmePacker().create_archive(tmp, json_path, archive_path)
+
+        start = time.perf_counter()
+        result = subprocess.run([sys.executable, emon, "list", archive_path], capture_output=True, text=True)
+        elapsed = time.perf_counter() - start
+
+        print(f"emon list: {elapsed:.3f}s (budget {EMON_STARTUP_BUDGET}s)")
+        assert result.returncode == 0, result.stdout + result.stderr
+        assert all(name in result.stdout for name in files)
+        assert elapsed < EMON_STARTUP_BUDGET
+
+        check = ("import sys, emon; emon.main(['list', sys.argv[1]]); "
+                 "print('heavy:', [m for m in ('PIL', 'numpy') if m in sys.modules])")
+        result = subprocess.run([sys.executable, "-c", check, archive_path],
+                                capture_output=True, text=True, cwd=repo)
+        assert "heavy: []" in result.stdout, result.stdout + result.stderr
+
+    print("Success: True")
+    print()
+
+
+def test_emon_subcommands():
+    """Test that emon takes its subcommand arguments from the tool modules and can patch"""
+    print("=== Testing emon Subcommands ===")
+
+    import emon
+    import ExEme
+    import PkEme
+    from ExEme import EmeArchive
+
+    def options(parser):
+        return [(a.dest, a.help) for a in parser._actions]
+
+    def subparser(argv):
+        parser = emon.build_parser(argv)
+        return parser._subparsers._group_actions[0].choices[argv[0]]
+
+    for argv, add_arguments in ((['extract'], ExEme.add_arguments),
+                                (['pack'], PkEme.add_pack_arguments),
+                                (['patch'], PkEme.add_patch_arguments),
+                                (['recover'], PkEme.add_recover_arguments)):
+        expected = argparse.ArgumentParser()
+        add_arguments(expected)
+        assert options(subparser(argv)) == options(expected), argv[0]
+
+    routine = bytes.fromhex("0104020800000000f962a8ec11000000f8e296ca0700000000000000000000000000000000000000")
+    files = {"a.bin": (b"A" * 2000, 5), "b.bin": (b"B" * 2000, 5)}
+
+    with tempfile.TemporaryDirectory() as tmp:
+        json_path = _write_pack_input(tmp, files, routine)
+        archive_path = os.path.join(tmp, "emon.eme")
+        assert emon.main(['pack', tmp, json_path, archive_path]) == 0
+
+        with open(os.path.join(tmp, "a.bin"), "wb") as f:
+            f.write(b"a" * 1500)
+        assert emon.main(['patch', archive_path, tmp, "a.bin"]) == 0
+        entry = next(e for e in EmeArchive(archive_path).entries if e['name'] == "a.bin")
+        assert entry['packed_size'] == 1500
+
+        bad_path = os.path.join(tmp, "bad.eme")
+        with open(bad_path, "wb") as f:
+            f.write(b"not an archive")
+        assert emon.main(['patch', bad_path, tmp, "a.bin"]) == 1
+        assert emon.main(['patch', os.path.join(tmp, "missing.eme"), tmp, "a.bin"]) == 1
+
+    print("Success: True")
+    print()
+
+
 def main():
     test_shift_operation_independent()
     test_full_routine()
     test_known_encrypted_data()
+    test_jsonl_manifest()
+    test_dedup_aliases()
+    test_adaptive_raw_script()
+    test_incremental_extract()
+    test_async_reads()
+    test_patch_archive()
+    test_copy_range_short_copies()
+    test_image_arrays()
+    test_emon_list_startup()
+    test_emon_subcommands()
 
 
 if __name__ == "__main__":